@@ -1,38 +1,103 @@
+import concurrent.futures
+import functools
+import io
 import os
 import hashlib
+import threading
 import json
+import mimetypes
+import queue
+import tarfile
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Tuple
 import logging
+from urllib3.util.retry import Retry
 
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import numpy as np
+import torch
 from PIL import Image
 from nodes import NODE_CLASS_MAPPINGS
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
 # Set up logging
 logger = logging.getLogger('R2BucketUploadNode')
 logger.setLevel(logging.INFO)
 
-# Ensure that r2client is installed
-try:
-    from r2client.R2Client import R2Client
-except ImportError:
-    logger.info("r2client not found, attempting to install...")
-    try:
-        import subprocess
-        import sys
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "r2client==0.2.1"])
-        from r2client.R2Client import R2Client
-        logger.info("Successfully installed r2client")
-    except Exception as e:
-        logger.error(f"Failed to install r2client: {str(e)}")
-        raise
+# Thread counts, also used to size the S3 connection pool
+_EXEC_WORKERS = 4
+_BACKGROUND_WORKERS = 2
+_TRANSFER_CONCURRENCY = 8
+
+# Multipart kicks in for large PNGs, 8 MiB parts uploaded 8 at a time
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=_TRANSFER_CONCURRENCY,
+    use_threads=True,
+)
+
+# Pooled Slack session so repeated notifications reuse the TLS connection
+_SLACK = requests.Session()
+_SLACK.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+
+# Shared worker pool for R2 uploads and Slack notifications
+_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=_EXEC_WORKERS, thread_name_prefix="r2-upload")
+
+# Background uploads for async_upload, drained by daemon threads so the node returns immediately.
+# Bounded so a batch loop blocks instead of piling up PNG bytes in memory.
+_UPLOAD_QUEUE = queue.Queue(maxsize=8)
+_UPLOAD_WORKERS = []
+_UPLOAD_WORKERS_LOCK = threading.Lock()
+
+def _upload_worker():
+    while True:
+        publish, args = _UPLOAD_QUEUE.get()
+        try:
+            publish(*args)
+        except Exception as e:
+            logger.error("Background upload failed: %s", e)
+        finally:
+            _UPLOAD_QUEUE.task_done()
+
+def _enqueue_upload(publish, args):
+    # Workers start on first use so importing the node stays free of threads
+    with _UPLOAD_WORKERS_LOCK:
+        if not _UPLOAD_WORKERS:
+            for i in range(_BACKGROUND_WORKERS):
+                worker = threading.Thread(target=_upload_worker, name=f"r2-background-{i}", daemon=True)
+                worker.start()
+                _UPLOAD_WORKERS.append(worker)
+    _UPLOAD_QUEUE.put((publish, args))
 
 class R2BucketUploadNode:
     CATEGORY = "utils"
     CATEGORY_DISPLAY_NAME = "🪣 R2 Storage"
 
+    # R2 clients shared across invocations, keyed by credentials and endpoint
+    _S3_CLIENT_CACHE = {}
+    _CLIENT_LOCK = threading.Lock()
+
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def INPUT_TYPES(cls):
+        # Defaults come from the environment, which doesn't change mid-process
         return {
             "required": {
                 "image": ("IMAGE",),
@@ -47,6 +112,10 @@ class R2BucketUploadNode:
                 "r2_bucket_name": ("STRING", {"default": os.getenv("R2_BUCKET_NAME", ""), "multiline": False}),
                 "r2_domain": ("STRING", {"default": os.getenv("R2_DOMAIN", ""), "multiline": False}),
             },
+            "optional": {
+                "r2_bundle": ("BOOLEAN", {"default": False}),
+                "async_upload": ("BOOLEAN", {"default": False}),
+            },
         }
 
     RETURN_TYPES = ("STRING", "STRING")  # Returning image_url and prompt_url
@@ -56,16 +125,34 @@ class R2BucketUploadNode:
 
     def upload_to_r2(self, image, prompt, negative_prompt, model, slack_webhook_url,
                      r2_access_key_id, r2_secret_access_key, r2_upload_path,
-                     r2_endpoint, r2_bucket_name, r2_domain) -> Tuple[str, str]:
+                     r2_endpoint, r2_bucket_name, r2_domain, r2_bundle=False,
+                     async_upload=False) -> Tuple[str, str]:
         try:
             # Validate image dimensions and format
-            if not isinstance(image, dict) or "image" not in image:
+            if hasattr(image, "shape"):
+                img_array = image
+            elif isinstance(image, dict) and "image" in image:
+                img_array = image["image"]
+            else:
                 raise ValueError("Invalid image input format")
 
-            img_array = image["image"]
+            # ComfyUI IMAGE tensors are (B, H, W, C) floats in [0, 1], take the
+            # first image and move it to the CPU as uint8 in one transfer
+            if isinstance(img_array, torch.Tensor):
+                if img_array.dim() == 4:
+                    if img_array.shape[0] > 1:
+                        logger.warning(
+                            "Received a batch of %d images, only the first is uploaded", img_array.shape[0]
+                        )
+                    img_array = img_array[0]
+                img_array = img_array.clamp(0, 1).mul(255).byte().contiguous().cpu().numpy()
+
             if len(img_array.shape) != 3 or img_array.shape[2] not in [3, 4]:
                 raise ValueError("Image must be RGB or RGBA")
 
+            if img_array.dtype != np.uint8:
+                raise ValueError(f"Image must be uint8, got {img_array.dtype}")
+
             if img_array.shape[0] < 32 or img_array.shape[1] < 32:
                 raise ValueError("Image dimensions too small (minimum 32x32)")
 
@@ -80,23 +167,12 @@ class R2BucketUploadNode:
             if not all([r2_access_key_id, r2_secret_access_key, r2_endpoint, r2_bucket_name, r2_domain]):
                 raise ValueError("Missing required R2 credentials in inputs or environment variables")
 
-            # Save image to a temporary file
-            temp_image_path = "temp_image.png"
-            try:
-                pil_image = Image.fromarray(image["image"])
-                pil_image.save(temp_image_path)
-                logger.info("Successfully saved temporary image")
-            except Exception as e:
-                logger.error(f"Failed to save temporary image: {str(e)}")
-                raise
+            # Hash the raw pixels, the key only needs to identify the content
+            file_hash = self.hash_pixels(img_array)
+            logger.debug("Generated file hash: %s", file_hash)
 
-            # Generate SHA256 hash of the image file
-            try:
-                file_hash = self.generate_sha256_file(temp_image_path)
-                logger.info(f"Generated file hash: {file_hash}")
-            except Exception as e:
-                logger.error(f"Failed to generate file hash: {str(e)}")
-                raise
+            # Encode PNG on a worker while the metadata is written and uploaded
+            f_png = _EXEC.submit(self.encode_png, img_array)
 
             # Create metadata dictionary
             data = {
@@ -105,116 +181,228 @@ class R2BucketUploadNode:
                 "model": model,
             }
 
-            # Save metadata to JSON file
-            output_json_path = f"{file_hash}.json"
+            # Serialize metadata to JSON bytes
             try:
-                with open(output_json_path, 'w') as json_file:
-                    json.dump(data, json_file, default=str)
-                logger.info("Successfully saved metadata JSON")
+                json_bytes = self.encode_json(data)
+                logger.debug("Successfully serialized metadata JSON")
             except Exception as e:
-                logger.error(f"Failed to save metadata JSON: {str(e)}")
+                logger.error("Failed to serialize metadata JSON: %s", e)
                 raise
 
-            # Upload JSON to R2
+            upload_kwargs = dict(
+                r2_access_key_id=r2_access_key_id,
+                r2_secret_access_key=r2_secret_access_key,
+                r2_upload_path=r2_upload_path,
+                r2_endpoint=r2_endpoint,
+                r2_bucket_name=r2_bucket_name,
+                r2_domain=r2_domain
+            )
+
+            if async_upload:
+                # Surface encode errors to the graph before handing off
+                f_png.result()
+
+                # URLs are deterministic, so return them now and upload in the background
+                _enqueue_upload(self.publish, (
+                    f_png, json_bytes, file_hash, upload_kwargs, r2_bundle,
+                    slack_webhook_url, prompt, negative_prompt, model
+                ))
+                base_url = f"https://{r2_domain}/{r2_upload_path}/{file_hash}"
+                if r2_bundle:
+                    return (f"{base_url}.tar?part=png", f"{base_url}.tar?part=json")
+                return (f"{base_url}.png", f"{base_url}.json")
+
+            return self.publish(
+                f_png, json_bytes, file_hash, upload_kwargs, r2_bundle,
+                slack_webhook_url, prompt, negative_prompt, model
+            )
+
+        except Exception as e:
+            logger.error("Error in upload_to_r2: %s", e)
+            raise
+
+    def publish(self, f_png, json_bytes, file_hash, upload_kwargs, r2_bundle,
+                slack_webhook_url, prompt, negative_prompt, model):
+        # Upload JSON while the PNG is still encoding, unless it goes into the bundle
+        f_json = None
+        if not r2_bundle:
+            f_json = _EXEC.submit(
+                self.upload_bytes_to_r2,
+                data=json_bytes,
+                file_name=f"{file_hash}.json",
+                **upload_kwargs
+            )
+
+        try:
+            png_bytes = f_png.result()
+            logger.debug("Successfully encoded image")
+        except Exception as e:
+            if f_json is not None:
+                f_json.cancel()
+            logger.error("Failed to encode image: %s", e)
+            raise
+
+        if r2_bundle:
+            # Single tar object holding both files, halving the PUT count
             try:
-                prompt_url = self.upload_file_to_r2(
-                    file_path=output_json_path,
-                    file_name=f"{file_hash}.json",
-                    r2_access_key_id=r2_access_key_id,
-                    r2_secret_access_key=r2_secret_access_key,
-                    r2_upload_path=r2_upload_path,
-                    r2_endpoint=r2_endpoint,
-                    r2_bucket_name=r2_bucket_name,
-                    r2_domain=r2_domain
+                bundle_url = self.upload_bytes_to_r2(
+                    data=self.bundle_tar(file_hash, png_bytes, json_bytes),
+                    file_name=f"{file_hash}.tar",
+                    **upload_kwargs
                 )
+                if not bundle_url:
+                    raise Exception("Failed to get bundle URL from R2")
+                logger.info("Successfully uploaded bundle to R2: %s", bundle_url)
+            except Exception as e:
+                logger.error("Failed to upload bundle to R2: %s", e)
+                raise
+
+            # Fragments never reach the server, so a Worker selects the member by query string
+            img_url = f"{bundle_url}?part=png"
+            prompt_url = f"{bundle_url}?part=json"
+        else:
+            # Upload the image concurrently with the JSON, the two objects are independent
+            f_img = _EXEC.submit(
+                self.upload_bytes_to_r2,
+                data=png_bytes,
+                file_name=f"{file_hash}.png",
+                **upload_kwargs
+            )
+
+            try:
+                prompt_url = f_json.result()
                 if not prompt_url:
                     raise Exception("Failed to get prompt URL from R2")
-                logger.info(f"Successfully uploaded JSON to R2: {prompt_url}")
+                logger.info("Successfully uploaded JSON to R2: %s", prompt_url)
             except Exception as e:
-                logger.error(f"Failed to upload JSON to R2: {str(e)}")
+                logger.error("Failed to upload JSON to R2: %s", e)
                 raise
 
-            # Upload image to R2
             try:
-                img_url = self.upload_file_to_r2(
-                    file_path=temp_image_path,
-                    file_name=f"{file_hash}.png",
-                    r2_access_key_id=r2_access_key_id,
-                    r2_secret_access_key=r2_secret_access_key,
-                    r2_upload_path=r2_upload_path,
-                    r2_endpoint=r2_endpoint,
-                    r2_bucket_name=r2_bucket_name,
-                    r2_domain=r2_domain
-                )
+                img_url = f_img.result()
                 if not img_url:
                     raise Exception("Failed to get image URL from R2")
-                logger.info(f"Successfully uploaded image to R2: {img_url}")
+                logger.info("Successfully uploaded image to R2: %s", img_url)
             except Exception as e:
-                logger.error(f"Failed to upload image to R2: {str(e)}")
+                logger.error("Failed to upload image to R2: %s", e)
                 raise
 
-            # Optionally send Slack message
-            if slack_webhook_url:
-                try:
-                    payload = self.format_slack_message(
-                        image_url=img_url,
-                        prompt_url=prompt_url,
-                        prompt=prompt,
-                        negative_prompt=negative_prompt,
-                        model=model
-                    )
-                    self.send_slack_message(payload, webhook_url=slack_webhook_url)
-                    logger.info("Successfully sent Slack message")
-                except Exception as e:
-                    logger.error(f"Failed to send Slack message: {str(e)}")
-                    # Don't raise here as Slack notification is optional
-
-            return (img_url, prompt_url)
+        # Optionally mirror the image under a second key to mask read-after-write lag,
+        # skipped in bundle mode where the extra PUT would defeat the point of bundling
+        alt_img_url = None
+        if os.getenv("R2_DOUBLEWRITE") == "1" and not r2_bundle:
+            alt_file_name = f"{file_hash}.b.png"
+            _EXEC.submit(
+                self.upload_bytes_to_r2,
+                data=png_bytes,
+                file_name=alt_file_name,
+                **upload_kwargs
+            )
+            alt_img_url = f"https://{upload_kwargs['r2_domain']}/{upload_kwargs['r2_upload_path']}/{alt_file_name}"
 
-        except Exception as e:
-            logger.error(f"Error in upload_to_r2: {str(e)}")
-            raise
-        finally:
-            # Clean up temporary files
+        # Optionally send Slack message in the background, it's not needed for the return value
+        if slack_webhook_url:
             try:
-                if os.path.exists(temp_image_path):
-                    os.remove(temp_image_path)
-                if os.path.exists(output_json_path):
-                    os.remove(output_json_path)
-                logger.info("Cleaned up temporary files")
+                payload = self.format_slack_message(
+                    image_url=img_url,
+                    prompt_url=prompt_url,
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
+                    model=model,
+                    alt_image_url=alt_img_url,
+                    image_preview=not r2_bundle
+                )
+                _EXEC.submit(self.send_slack_message, payload, webhook_url=slack_webhook_url)
             except Exception as e:
-                logger.error(f"Failed to clean up temporary files: {str(e)}")
+                logger.error("Failed to send Slack message: %s", e)
+                # Don't raise here as Slack notification is optional
 
-    def upload_file_to_r2(self, file_path, file_name, r2_access_key_id, r2_secret_access_key,
-                          r2_upload_path, r2_endpoint, r2_bucket_name, r2_domain):
+        return (img_url, prompt_url)
+
+    def _get_s3_client(self, r2_access_key_id, r2_secret_access_key, r2_endpoint):
+        key = (r2_access_key_id, r2_secret_access_key, r2_endpoint)
+        with self._CLIENT_LOCK:
+            client = self._S3_CLIENT_CACHE.get(key)
+            if client is None:
+                client = boto3.client(
+                    "s3",
+                    endpoint_url=r2_endpoint,
+                    aws_access_key_id=r2_access_key_id,
+                    aws_secret_access_key=r2_secret_access_key,
+                    region_name="auto",
+                    # Enough connections for every uploading thread to run a full multipart transfer
+                    config=Config(
+                        max_pool_connections=(_EXEC_WORKERS + _BACKGROUND_WORKERS) * _TRANSFER_CONCURRENCY
+                    ),
+                )
+                self._S3_CLIENT_CACHE[key] = client
+        return client
+
+    def upload_bytes_to_r2(self, data, file_name, r2_access_key_id, r2_secret_access_key,
+                           r2_upload_path, r2_endpoint, r2_bucket_name, r2_domain):
         try:
-            r2 = R2Client(
-                access_key=r2_access_key_id,
-                secret_key=r2_secret_access_key,
-                endpoint=r2_endpoint,
-            )
+            s3 = self._get_s3_client(r2_access_key_id, r2_secret_access_key, r2_endpoint)
 
             upload_path = f"{r2_upload_path}/{file_name}"
-            r2.upload_file(r2_bucket_name, file_path, upload_path)
+            s3.upload_fileobj(
+                io.BytesIO(data),
+                r2_bucket_name,
+                upload_path,
+                ExtraArgs={"ContentType": mimetypes.guess_type(file_name)[0] or "application/octet-stream"},
+                Config=_TRANSFER_CONFIG,
+            )
             url = f"https://{r2_domain}/{upload_path}"
-            logger.info(f"Successfully uploaded file to R2: {url}")
+            logger.debug("Successfully uploaded file to R2: %s", url)
             return url
         except Exception as e:
-            logger.error(f"Failed to upload file to R2: {str(e)}")
+            logger.error("Failed to upload file to R2: %s", e)
             return None
 
-    def generate_sha256_file(self, file_path):
-        try:
-            sha256_hash = hashlib.sha256()
-            with open(file_path, "rb") as file:
-                for byte_block in iter(lambda: file.read(4096), b""):
-                    sha256_hash.update(byte_block)
-            return sha256_hash.hexdigest()
-        except Exception as e:
-            logger.error(f"Failed to generate SHA256 hash: {str(e)}")
-            raise
+    def hash_pixels(self, img_array):
+        pixels = np.ascontiguousarray(img_array).view(np.uint8)
+        # sha256 is the default; keys are hashed from pixels, so they don't match objects
+        # uploaded when the key was a hash of the PNG file
+        algorithm = os.getenv("R2_HASH", "sha256").lower()
+        if algorithm == "blake3":
+            if blake3 is None:
+                raise ValueError("R2_HASH=blake3 requires the blake3 package (pip install blake3)")
+            h = blake3(max_threads=blake3.AUTO)
+        elif algorithm == "sha256":
+            h = hashlib.sha256()
+        else:
+            raise ValueError(f"Unsupported R2_HASH algorithm: {algorithm}")
+        # Include shape and dtype so images with the same bytes but different layouts get different keys
+        h.update(repr((img_array.shape, img_array.dtype.str)).encode())
+        h.update(pixels)
+        return h.hexdigest()
 
-    def format_slack_message(self, image_url, prompt_url, prompt, negative_prompt, model):
+    def encode_png(self, img_array):
+        # Build the image in the encoder's native mode from a contiguous buffer; Pillow can
+        # wrap RGBA without copying, RGB still falls back to a copy via frombytes
+        mode = "RGBA" if img_array.shape[2] == 4 else "RGB"
+        pixels = np.ascontiguousarray(img_array)
+        pil_image = Image.frombuffer(mode, (pixels.shape[1], pixels.shape[0]), pixels, "raw", mode, 0, 1)
+        # PNG is lossless at any level, level 1 is the fastest to encode
+        buf = io.BytesIO()
+        pil_image.save(buf, format="PNG", compress_level=1)
+        return buf.getvalue()
+
+    def encode_json(self, data):
+        if orjson is not None:
+            return orjson.dumps(data, default=str)
+        return json.dumps(data, default=str).encode("utf-8")
+
+    def bundle_tar(self, file_hash, png_bytes, json_bytes):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tf:
+            for name, payload in ((f"{file_hash}.png", png_bytes), (f"{file_hash}.json", json_bytes)):
+                info = tarfile.TarInfo(name)
+                info.size = len(payload)
+                tf.addfile(info, io.BytesIO(payload))
+        return buf.getvalue()
+
+    def format_slack_message(self, image_url, prompt_url, prompt, negative_prompt, model, alt_image_url=None,
+                             image_preview=True):
         blocks = {
             "blocks": [
                 {
@@ -254,16 +442,31 @@ class R2BucketUploadNode:
                 }
             ]
         }
+        if alt_image_url:
+            blocks["blocks"][-1]["elements"].append({
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "text": "🪞 Mirror Link",
+                    "emoji": True
+                },
+                "url": alt_image_url
+            })
+        # Slack rejects the whole message if the image block doesn't point at an actual image
+        if not image_preview:
+            blocks["blocks"] = blocks["blocks"][1:]
         return blocks
 
     def send_slack_message(self, payload, webhook_url):
         try:
-            result = requests.post(webhook_url, json=payload)
-            result.raise_for_status()
+            # Read the body and close so the connection goes straight back to the pool
+            with _SLACK.post(webhook_url, json=payload, timeout=5) as result:
+                result.raise_for_status()
+                _ = result.content
             logger.info("Successfully sent Slack message")
             return result
         except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to send Slack message: {str(e)}")
+            logger.error("Failed to send Slack message: %s", e)
             return None
 
 # Register the node